@@ -2,12 +2,27 @@
 """Run perft on BBY and a reference engine, highlighting mismatches."""
 
 import argparse
+import json
+import os
+import queue
 import re
+import select
+import shutil
 import subprocess
+import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
+
+_NODES_RE = re.compile(rb"nodes=(\d+)")
+_TIME_MS_RE = re.compile(rb"time_ms=(\d+)")
+OUTPUT_TAIL_LINES = 20
+FEN_WIDTH = 35
+DEFAULT_REF_CACHE = Path.home() / ".cache" / "bby" / "perft_ref.json"
 
 
 @dataclass
@@ -20,7 +35,7 @@ class Reference:
 @dataclass
 class Sample:
     nodes: int
-    millis: int
+    millis: Optional[int]  # None when the node count came from the reference cache
 
 
 def load_suite(path: Path) -> List[Reference]:
@@ -35,39 +50,316 @@ def load_suite(path: Path) -> List[Reference]:
     return refs
 
 
-def run_bby_perft(binary: Path, fen: str, depth: int, timeout: float) -> Sample:
+@dataclass
+class Launch:
+    proc: subprocess.Popen
+    start_ns: int
+
+
+def _collect(launch: Launch, timeout: float) -> Tuple[bytes, bytes, int]:
+    try:
+        stdout, stderr = launch.proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        launch.proc.kill()
+        launch.proc.communicate()
+        raise
+    elapsed = (time.perf_counter_ns() - launch.start_ns) // 1_000_000
+    return stdout, stderr, elapsed
+
+
+def launch_bby_perft(binary: Path, fen: str, depth: int) -> Launch:
     cmd = [str(binary), "--fen", fen, "--depth", str(depth)]
-    start = time.perf_counter()
-    proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
-    elapsed = int((time.perf_counter() - start) * 1000.0)
-    if proc.returncode != 0:
-        raise RuntimeError(f"bby-perft failed: {proc.stderr}")
-    match = re.search(r"nodes=(\d+)", proc.stdout)
+    start_ns = time.perf_counter_ns()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return Launch(proc=proc, start_ns=start_ns)
+
+
+def finish_bby_perft(launch: Launch, timeout: float) -> Sample:
+    stdout, stderr, elapsed = _collect(launch, timeout)
+    if launch.proc.returncode != 0:
+        raise RuntimeError(f"bby-perft failed: {stderr.decode(errors='replace')}")
+    match = _NODES_RE.search(stdout)
     if not match:
-        raise RuntimeError(f"Unable to parse nodes from bby output:\n{proc.stdout}")
+        raise RuntimeError(f"Unable to parse nodes from bby output:\n{stdout.decode(errors='replace')}")
     nodes = int(match.group(1))
+    # The reference engine is collected first, so wall clock here may include time spent
+    # waiting on it; prefer the search time bby-perft reports for itself.
+    reported = _TIME_MS_RE.search(stdout)
+    if reported:
+        elapsed = int(reported.group(1))
     return Sample(nodes=nodes, millis=elapsed)
 
 
-def run_engine_perft(engine: Path, fen: str, depth: int, timeout: float) -> Sample:
-    commands = f"uci\nsetoption name Threads value 1\nposition fen {fen}\ngo perft {depth}\nquit\n"
-    start = time.perf_counter()
-    proc = subprocess.run([str(engine)], input=commands, capture_output=True,
-                          text=True, timeout=timeout)
-    elapsed = int((time.perf_counter() - start) * 1000.0)
-    if proc.returncode != 0:
-        raise RuntimeError(f"Engine {engine} failed: {proc.stderr}")
-    nodes = None
-    for line in reversed(proc.stdout.splitlines()):
-        if "Nodes searched:" in line:
+def read_until(proc: subprocess.Popen, buf: bytearray, token: bytes, deadline: Optional[float]) -> str:
+    """Return the first line of ``proc``'s stdout that starts with ``token``.
+
+    ``proc`` must have an unbuffered (``bufsize=0``) stdout; bytes read past the
+    returned line stay in ``buf`` for the next call. Raises TimeoutError once the
+    ``time.monotonic()`` ``deadline`` passes (None waits forever) and RuntimeError
+    if the process closes its stdout first.
+    """
+    assert proc.stdout is not None
+    fd = proc.stdout.fileno()
+    wanted = repr(token.decode()) if token else "a reply"
+    # Engines can print a lot before the reply (go perft prints every root move); scan
+    # it line by line and keep only a short tail for diagnostics.
+    tail: "deque[bytes]" = deque(maxlen=OUTPUT_TAIL_LINES)
+    while True:
+        start = 0
+        newline = buf.find(b"\n")
+        while newline != -1:
+            line = bytes(buf[start:newline]).strip()
+            start = newline + 1
+            if line.startswith(token):
+                del buf[:start]
+                return line.decode(errors="replace")
+            tail.append(line)
+            newline = buf.find(b"\n", start)
+        # Scanned lines can never match; only a trailing partial line is kept.
+        del buf[:start]
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            output = b"\n".join(tail).decode(errors="replace")
+            raise TimeoutError(f"{proc.args[0]} timed out waiting for {wanted}; last output:\n{output}")
+        # select rather than a blocking read: a stalled process (or a child still holding
+        # the pipe after it died) would otherwise never produce EOF.
+        ready, _, _ = select.select([fd], [], [], remaining)
+        if not ready:
+            continue
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            output = b"\n".join(tail).decode(errors="replace")
+            raise RuntimeError(f"{proc.args[0]} exited before sending {wanted}; last output:\n{output}")
+        buf += chunk
+
+
+class RefEngine:
+    """Long-lived UCI reference engine reused across suite entries."""
+
+    def __init__(self, path: Path, threads: int = 1) -> None:
+        self.path = path
+        self.threads = threads
+        self.proc = subprocess.Popen(
+            [str(path)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+        self._buf = bytearray()
+        self._start_ns = 0
+
+    def _write(self, command: str) -> None:
+        assert self.proc.stdin is not None
+        self.proc.stdin.write(command.encode() + b"\n")
+
+    def initialise(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        self._write("uci")
+        read_until(self.proc, self._buf, b"uciok", deadline)
+        self._write(f"setoption name Threads value {self.threads}")
+        self._write("isready")
+        read_until(self.proc, self._buf, b"readyok", deadline)
+
+    def start_perft(self, fen: str, depth: int, deadline: float) -> None:
+        self._write("ucinewgame")
+        self._write(f"position fen {fen}")
+        self._write("isready")
+        read_until(self.proc, self._buf, b"readyok", deadline)
+        self._start_ns = time.perf_counter_ns()
+        self._write(f"go perft {depth}")
+
+    def finish_perft(self, deadline: float) -> Sample:
+        line = read_until(self.proc, self._buf, b"Nodes searched:", deadline)
+        elapsed = (time.perf_counter_ns() - self._start_ns) // 1_000_000
+        try:
+            nodes = int(line.split(":", 1)[1])
+        except ValueError:
+            raise RuntimeError(f"Could not parse node summary from engine output: {line}") from None
+        return Sample(nodes=nodes, millis=elapsed)
+
+    def perft(self, fen: str, depth: int, timeout: float) -> Sample:
+        # One deadline covers the readyok handshake as well as go perft itself.
+        deadline = time.monotonic() + timeout
+        self.start_perft(fen, depth, deadline)
+        return self.finish_perft(deadline)
+
+    def quit(self) -> None:
+        try:
+            self._write("quit")
+        except (BrokenPipeError, ValueError):
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class EnginePool:
+    """Hands out persistent RefEngines, starting at most ``size`` of them on first use."""
+
+    def __init__(self, path: Path, size: int, threads: int = 1) -> None:
+        self.path = path
+        self.threads = threads
+        self._idle: "queue.Queue[Optional[RefEngine]]" = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+        self._started: List[RefEngine] = []
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> RefEngine:
+        engine = self._idle.get()
+        if engine is None:
             try:
-                nodes = int(line.split(":", 1)[1].strip())
-            except ValueError:
-                pass
-            break
-    if nodes is None:
-        raise RuntimeError(f"Could not find node summary in engine output:\n{proc.stdout}")
-    return Sample(nodes=nodes, millis=elapsed)
+                engine = RefEngine(self.path, self.threads)
+            except BaseException:
+                # Popen failed; hand the slot back so other workers don't block on it.
+                self._idle.put(None)
+                raise
+            with self._lock:
+                self._started.append(engine)
+            try:
+                engine.initialise(timeout)
+            except BaseException:
+                self.discard(engine)
+                raise
+        return engine
+
+    def release(self, engine: RefEngine) -> None:
+        self._idle.put(engine)
+
+    def discard(self, engine: RefEngine) -> None:
+        """Shut down an engine in an unknown state; a fresh one is started on next use."""
+        with self._lock:
+            if engine in self._started:
+                self._started.remove(engine)
+        # It may be stalled and never read 'quit', so don't wait for a clean exit.
+        engine.proc.kill()
+        engine.proc.wait()
+        self._idle.put(None)
+
+    def close(self) -> None:
+        with self._lock:
+            for engine in self._started:
+                engine.quit()
+            self._started.clear()
+
+
+class RefCache:
+    """Reference node counts on disk, keyed by engine binary, its mtime, FEN and depth."""
+
+    def __init__(self, path: Path, engine: Path) -> None:
+        self.path = path
+        self._prefix = f"{engine.resolve()}|{engine.stat().st_mtime_ns}"
+        self._entries = self._load()
+        self._added: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, int]:
+        try:
+            with self.path.open("r", encoding="utf-8") as handle:
+                data = json.load(handle)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            print(f"warning: ignoring unreadable reference cache {self.path}: {exc}", file=sys.stderr)
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _key(self, fen: str, depth: int) -> str:
+        return f"{self._prefix}|{fen}|{depth}"
+
+    def get(self, fen: str, depth: int) -> Optional[int]:
+        with self._lock:
+            return self._entries.get(self._key(fen, depth))
+
+    def put(self, fen: str, depth: int, nodes: int) -> None:
+        key = self._key(fen, depth)
+        with self._lock:
+            self._entries[key] = nodes
+            self._added[key] = nodes
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._added:
+                return
+            # Merge with whatever other runs wrote meanwhile; tmpfile + rename keeps the
+            # file whole even when several comparisons finish at once.
+            merged = self._load()
+            merged.update(self._added)
+            tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with tmp.open("w", encoding="utf-8") as handle:
+                    json.dump(merged, handle, sort_keys=True, indent=0)
+                os.replace(tmp, self.path)
+            except OSError as exc:
+                # The cache is only an optimisation; never fail a comparison run over it.
+                print(f"warning: could not write reference cache {self.path}: {exc}", file=sys.stderr)
+                try:
+                    tmp.unlink()
+                except OSError:
+                    pass
+                return
+            self._added.clear()
+
+
+def shorten_fen(fen: str, width: int = FEN_WIDTH) -> str:
+    # Leave at least one space before the depth column.
+    if len(fen) < width:
+        return fen
+    return fen[: width - 4] + "..."
+
+
+@dataclass
+class Outcome:
+    depth: int
+    bby: Sample
+    ref: Sample
+    status_bits: List[str]
+    ok: bool
+
+
+def compare_position(bby_bin: Path, engines: EnginePool, cache: Optional[RefCache],
+                     ref: Reference, depth_cap: Optional[int], timeout: float) -> Outcome:
+    depth = ref.depth if depth_cap is None else min(ref.depth, depth_cap)
+    cached = cache.get(ref.fen, depth) if cache is not None else None
+    bby_launch = launch_bby_perft(bby_bin, ref.fen, depth)
+    if cached is not None:
+        ref_sample = Sample(nodes=cached, millis=None)
+    else:
+        try:
+            engine = engines.acquire(timeout)
+            try:
+                ref_sample = engine.perft(ref.fen, depth, timeout)
+            except BaseException:
+                # A killed or half-way engine must not be handed to the next position.
+                engines.discard(engine)
+                raise
+            engines.release(engine)
+        except BaseException:
+            bby_launch.proc.kill()
+            bby_launch.proc.communicate()
+            raise
+        if cache is not None:
+            cache.put(ref.fen, depth, ref_sample.nodes)
+    bby_sample = finish_bby_perft(bby_launch, timeout)
+
+    ok = True
+    status_bits: List[str] = []
+    if bby_sample.nodes == ref_sample.nodes:
+        status_bits.append("eq")
+    else:
+        status_bits.append("diff")
+        ok = False
+    if depth == ref.depth and ref.nodes:
+        if bby_sample.nodes == ref.nodes:
+            status_bits.append("ref")
+        else:
+            status_bits.append("refdiff")
+            ok = False
+    return Outcome(depth=depth, bby=bby_sample, ref=ref_sample, status_bits=status_bits, ok=ok)
 
 
 def main() -> int:
@@ -80,38 +372,73 @@ def main() -> int:
                         help="Optional depth cap; runs min(ref_depth, cap)")
     parser.add_argument("--timeout", type=float, default=120.0,
                         help="Per-position timeout in seconds (default 120)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Positions to run in parallel (default: half the CPU count)")
+    parser.add_argument("--fail-fast", action="store_true",
+                        help="Stop at the first position that does not match")
+    parser.add_argument("--full-fen", action="store_true",
+                        help="Print whole FENs instead of truncating them to the FEN column")
+    parser.add_argument("--ref-threads", type=int, default=1,
+                        help="UCI Threads for each reference engine; engines with parallel perft "
+                             "scale with it (default 1)")
+    parser.add_argument("--ref-cache", type=Path, default=DEFAULT_REF_CACHE,
+                        help=f"JSON cache of reference node counts (default: {DEFAULT_REF_CACHE})")
+    parser.add_argument("--no-ref-cache", action="store_true",
+                        help="Always run the reference engine, ignoring --ref-cache")
     args = parser.parse_args()
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be positive")
+    if args.ref_threads < 1:
+        parser.error("--ref-threads must be positive")
 
     suite = load_suite(Path(args.suite))
     bby_bin = Path(args.bby)
-    engine_bin = Path(args.engine)
+    resolved = shutil.which(args.engine)
+    if resolved is None:
+        parser.error(f"reference engine not found: {args.engine}")
+    engine_bin = Path(resolved)
+    cache = None if args.no_ref_cache else RefCache(args.ref_cache, engine_bin)
 
-    header = f"{'#':<3}{'FEN':<35}{'dep':<4}{'BBY nodes':>14}{'BBY ms':>10}{'Ref nodes':>14}{'Ref ms':>10}{'status':>10}"
+    header = f"{'#':<3}{'FEN':<{FEN_WIDTH}}{'dep':<4}{'BBY nodes':>14}{'BBY ms':>10}{'Ref nodes':>14}{'Ref ms':>10}{'status':>10}"
     print(header)
     print("-" * len(header))
 
+    # Each job drives two engine processes, so default to half the cores.
+    jobs = args.jobs if args.jobs is not None else max(1, (os.cpu_count() or 2) // 2)
+    tasks: List[Tuple[int, Reference]] = list(enumerate(suite, start=1))
     all_ok = True
-    for idx, ref in enumerate(suite, start=1):
-        depth = ref.depth if args.depth is None else min(ref.depth, args.depth)
-        bby_sample = run_bby_perft(bby_bin, ref.fen, depth, args.timeout)
-        ref_sample = run_engine_perft(engine_bin, ref.fen, depth, args.timeout)
-
-        status_bits = []
-        if bby_sample.nodes == ref_sample.nodes:
-            status_bits.append("eq")
-        else:
-            status_bits.append("diff")
-            all_ok = False
-        if depth == ref.depth and ref.nodes:
-            if bby_sample.nodes == ref.nodes:
-                status_bits.append("ref")
-            else:
-                status_bits.append("refdiff")
-                all_ok = False
-
-        print(f"{idx:<3}{ref.fen:<35}{depth:<4}{bby_sample.nodes:>14}{bby_sample.millis:>10}"
-              f"{ref_sample.nodes:>14}{ref_sample.millis:>10}{','.join(status_bits):>10}")
-
+    # At most one persistent reference engine per job, started only on a cache miss.
+    engines = EnginePool(engine_bin, max(1, min(jobs, len(tasks))), args.ref_threads)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                idx: pool.submit(compare_position, bby_bin, engines, cache, ref, args.depth, args.timeout)
+                for idx, ref in tasks
+            }
+            # Print in suite order so output stays deterministic regardless of completion order.
+            try:
+                for idx, ref in tasks:
+                    outcome = futures[idx].result()
+                    if not outcome.ok:
+                        all_ok = False
+                    ref_ms = "cached" if outcome.ref.millis is None else outcome.ref.millis
+                    fen = ref.fen if args.full_fen else shorten_fen(ref.fen)
+                    print(f"{idx:<3}{fen:<{FEN_WIDTH}}{outcome.depth:<4}{outcome.bby.nodes:>14}{outcome.bby.millis:>10}"
+                          f"{outcome.ref.nodes:>14}{ref_ms:>10}{','.join(outcome.status_bits):>10}",
+                          flush=True)
+                    if args.fail_fast and not outcome.ok:
+                        # Drop queued positions; ones already running finish but are not reported.
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        break
+            except BaseException:
+                # Ctrl-C or a failed position: don't let the executor's exit run the rest
+                # of the suite.
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        engines.close()
+        if cache is not None:
+            cache.save()
     return 0 if all_ok else 1
 
 
@@ -5,10 +5,16 @@ import argparse
 import re
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Optional
 
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks; the single write below still helps
+    fcntl = None  # type: ignore[assignment]
+
 STARTPOS = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 
 @dataclass
@@ -30,19 +36,19 @@ CASES: List[TelemetryCase] = [
     TelemetryCase(name="startpos-d7", fen=STARTPOS, depth=7, max_time_ms=60_000),
 ]
 
-LINE_PATTERN = re.compile(r"nodes=(\d+).*time_ms=(\d+).*nps=(\d+)")
+LINE_PATTERN = re.compile(rb"nodes=(\d+).*time_ms=(\d+).*nps=(\d+)")
 
 
 def run_case(binary: Path, case: TelemetryCase, timeout: float) -> Sample:
     cmd = [str(binary), "--fen", case.fen, "--depth", str(case.depth)]
-    start = time.perf_counter()
-    proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
-    elapsed_ms = int((time.perf_counter() - start) * 1000.0)
+    start_ns = time.perf_counter_ns()
+    proc = subprocess.run(cmd, capture_output=True, timeout=timeout)
+    elapsed_ms = (time.perf_counter_ns() - start_ns) // 1_000_000
     if proc.returncode != 0:
-        raise RuntimeError(f"bby-perft failed: {proc.stderr}")
+        raise RuntimeError(f"bby-perft failed: {proc.stderr.decode(errors='replace')}")
     match = LINE_PATTERN.search(proc.stdout)
     if not match:
-        raise RuntimeError(f"Unable to parse perft output:\n{proc.stdout}")
+        raise RuntimeError(f"Unable to parse perft output:\n{proc.stdout.decode(errors='replace')}")
     nodes, time_ms, nps = map(int, match.groups())
     # fall back to wall clock if reported time is zero (should not happen)
     if time_ms == 0:
@@ -69,6 +75,9 @@ def main() -> int:
                         help="Per test timeout in seconds (default 600)")
     parser.add_argument("--output", type=Path, default=None,
                         help="Optional file to append telemetry results")
+    parser.add_argument("--parallel", action="store_true",
+                        help="Run cases concurrently; faster, but they contend for cache, memory "
+                             "bandwidth and turbo, so nps gates are less reliable")
     args = parser.parse_args()
 
     binary = Path(args.bby)
@@ -76,19 +85,37 @@ def main() -> int:
     header = f"{'case':<14}{'depth':>6}{'nodes':>16}{'time(ms)':>12}{'nps':>12}{'status':>12}"
     print(header)
     print("-" * len(header))
-    for case in CASES:
-        sample = run_case(binary, case, timeout=args.timeout)
-        status = describe(case, sample)
-        line = f"{case.name:<14}{case.depth:>6}{sample.nodes:>16}{sample.time_ms:>12}{sample.nps:>12}{status:>12}"
-        print(line)
-        lines.append(line)
+    # Sequential by default: the NPS gates assume each bby-perft has the machine to itself.
+    workers = len(CASES) if args.parallel else 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_case, binary, case, args.timeout) for case in CASES]
+        try:
+            for case, future in zip(CASES, futures):
+                sample = future.result()
+                status = describe(case, sample)
+                line = f"{case.name:<14}{case.depth:>6}{sample.nodes:>16}{sample.time_ms:>12}{sample.nps:>12}{status:>12}"
+                print(line, flush=True)
+                lines.append(line)
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    if args.parallel:
+        note = "note: cases ran concurrently (--parallel); nps is not a single-process measurement"
+        print(note)
+        lines.append(note)
     if args.output:
         args.output.parent.mkdir(parents=True, exist_ok=True)
+        blob = time.strftime("%Y-%m-%d %H:%M:%S") + "\n" + "\n".join(lines) + "\n\n"
+        # One locked append per run so concurrent CI jobs never interleave their blocks.
         with args.output.open("a", encoding="utf-8") as handle:
-            handle.write(time.strftime("%Y-%m-%d %H:%M:%S"))
-            handle.write("\n")
-            handle.write("\n".join(lines))
-            handle.write("\n\n")
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                handle.write(blob)
+                handle.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
     return 0
 
 
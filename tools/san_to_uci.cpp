@@ -1,29 +1,102 @@
 #include <iostream>
 #include <string>
+#include <string_view>
 #include "../third_party/chess-library/chess.hpp"
 
-int main() {
-  std::string fen;
-  if (!std::getline(std::cin, fen)) {
-    std::cerr << "missing fen" << std::endl;
-    return 1;
+namespace {
+
+// chess::Board trusts its input: a placement without both kings trips an
+// assert in kingSq() (or reads garbage under NDEBUG), which would take the
+// whole converter down. Reject such FENs up front; returns nullptr if usable.
+const char* fen_error(std::string_view fen) {
+  const std::size_t space = fen.find(' ');
+  const std::string_view placement = fen.substr(0, space);
+  int ranks = 1;
+  int files = 0;
+  int white_kings = 0;
+  int black_kings = 0;
+  for (const char c : placement) {
+    if (c == '/') {
+      if (files != 8) {
+        return "fen rank does not have 8 squares";
+      }
+      ++ranks;
+      files = 0;
+    } else if (c >= '1' && c <= '8') {
+      files += c - '0';
+    } else if (std::string_view("pnbrqkPNBRQK").find(c) != std::string_view::npos) {
+      ++files;
+      white_kings += c == 'K';
+      black_kings += c == 'k';
+    } else {
+      return "unexpected character in fen piece placement";
+    }
+    if (files > 8) {
+      return "fen rank does not have 8 squares";
+    }
   }
-  std::string san;
-  if (!std::getline(std::cin, san)) {
-    std::cerr << "missing san" << std::endl;
-    return 1;
+  if (ranks != 8 || files != 8) {
+    return "fen piece placement does not have 8 ranks";
   }
-  try {
-    chess::Board board(fen);
-    const chess::Move move = chess::uci::parseSan(board, san);
-    if (move == chess::Move::NO_MOVE) {
-      std::cerr << "error: no move" << std::endl;
+  if (white_kings != 1 || black_kings != 1) {
+    return "fen needs exactly one king per side";
+  }
+  if (space == std::string_view::npos) {
+    return "fen is missing the side to move";
+  }
+  const std::string_view side = fen.substr(space + 1, fen.find(' ', space + 1) - space - 1);
+  if (side != "w" && side != "b") {
+    return "fen side to move must be w or b";
+  }
+  return nullptr;
+}
+
+}  // namespace
+
+// Reads (fen, san) line pairs from stdin until EOF and writes exactly one
+// stdout line per pair: the UCI move, or "error: ..." when conversion fails.
+// Exits non-zero if any pair failed.
+int main() {
+  int status = 0;
+  std::string fen;
+  while (std::getline(std::cin, fen)) {
+    if (!fen.empty() && fen.back() == '\r') {
+      fen.pop_back();
+    }
+    if (fen.empty()) {
+      continue;
+    }
+    std::string san;
+    if (!std::getline(std::cin, san)) {
+      std::cout << "error: missing san" << std::endl;
       return 1;
     }
-    std::cout << chess::uci::moveToUci(move) << std::endl;
-  } catch (const std::exception& ex) {
-    std::cerr << "error: " << ex.what() << std::endl;
-    return 1;
+    if (!san.empty() && san.back() == '\r') {
+      san.pop_back();
+    }
+    if (const char* error = fen_error(fen)) {
+      std::cout << "error: " << error << std::endl;
+      status = 1;
+      continue;
+    }
+    try {
+      chess::Board board;
+      if (!board.setFen(fen)) {
+        std::cout << "error: invalid fen" << std::endl;
+        status = 1;
+        continue;
+      }
+      const chess::Move move = chess::uci::parseSan(board, san);
+      if (move == chess::Move::NO_MOVE) {
+        std::cout << "error: no move" << std::endl;
+        status = 1;
+        continue;
+      }
+      std::cout << chess::uci::moveToUci(move) << std::endl;
+    } catch (const std::exception& ex) {
+      std::cout << "error: " << ex.what() << std::endl;
+      status = 1;
+    }
   }
-  return 0;
+  return status;
 }
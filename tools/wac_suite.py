@@ -9,16 +9,31 @@ chess-library helper via the ``bby-san-to-uci`` tool.
 from __future__ import annotations
 
 import argparse
+import json
+import os
+import select
 import subprocess
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable, List, Optional, Sequence, Set, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
 REPO_ROOT = Path(__file__).resolve().parents[1]
 DEFAULT_ENGINE = REPO_ROOT / "build" / "release" / "Engine-Test"
 DEFAULT_CONVERTER = REPO_ROOT / "build" / "release" / "bby-san-to-uci"
 DEFAULT_EPD = REPO_ROOT / "tests" / "positions" / "wacnew.epd"
+# A conversion is a single parse; a converter silent for this long is wedged.
+CONVERT_TIMEOUT = 10.0
+OUTPUT_TAIL_LINES = 20
+
+# CPython only starts children via posix_spawn (no page-table copy of this process)
+# when close_fds is False. That is safe here: descriptors Python creates are
+# non-inheritable by default (PEP 446), so only the child's stdio pipes are passed.
+SPAWN_KWARGS: Dict[str, Any] = {"close_fds": False}
 
 
 @dataclass
@@ -35,95 +50,198 @@ def parse_epd(epd_path: Path, limit: Optional[int]) -> List[Position]:
             raw = line.strip()
             if not raw or raw.startswith("#"):
                 continue
-            bm_idx = raw.find(" bm ")
-            if bm_idx == -1:
+            # One left-to-right pass: FEN | bm operand | remaining opcodes.
+            head, sep, tail = raw.partition(" bm ")
+            if not sep:
                 continue
-            fen = raw[:bm_idx].strip()
-            rhs = raw[bm_idx + 4 :]
-            semi = rhs.find(";")
-            if semi == -1:
+            bm_field, sep, rest = tail.partition(";")
+            if not sep:
                 continue
-            san_field = rhs[:semi].strip()
-            sans = [token for token in san_field.replace(",", " ").split() if token]
+            sans = bm_field.replace(",", " ").split()
             if not sans:
                 continue
-            ident = ""
-            id_marker = rhs.find('id "')
-            if id_marker != -1:
-                end = rhs.find('"', id_marker + 4)
-                if end != -1:
-                    ident = rhs[id_marker + 4 : end]
-            positions.append(Position(fen=fen, sans=sans, ident=ident))
+            _, _, after_id = rest.partition('id "')
+            ident, _, _ = after_id.partition('"')
+            positions.append(Position(fen=head.strip(), sans=sans, ident=ident))
             if limit is not None and len(positions) >= limit:
                 break
     return positions
 
 
+def read_until(proc: subprocess.Popen, buf: bytearray, token: bytes, deadline: Optional[float]) -> str:
+    """Return the first line of ``proc``'s stdout that starts with ``token``.
+
+    ``proc`` must have an unbuffered (``bufsize=0``) stdout; bytes read past the
+    returned line stay in ``buf`` for the next call. Raises TimeoutError once the
+    ``time.monotonic()`` ``deadline`` passes (None waits forever) and RuntimeError
+    if the process closes its stdout first.
+    """
+    assert proc.stdout is not None
+    fd = proc.stdout.fileno()
+    wanted = repr(token.decode()) if token else "a reply"
+    # Engines can print a lot before the reply (go perft prints every root move); scan
+    # it line by line and keep only a short tail for diagnostics.
+    tail: "deque[bytes]" = deque(maxlen=OUTPUT_TAIL_LINES)
+    while True:
+        start = 0
+        newline = buf.find(b"\n")
+        while newline != -1:
+            line = bytes(buf[start:newline]).strip()
+            start = newline + 1
+            if line.startswith(token):
+                del buf[:start]
+                return line.decode(errors="replace")
+            tail.append(line)
+            newline = buf.find(b"\n", start)
+        # Scanned lines can never match; only a trailing partial line is kept.
+        del buf[:start]
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            output = b"\n".join(tail).decode(errors="replace")
+            raise TimeoutError(f"{proc.args[0]} timed out waiting for {wanted}; last output:\n{output}")
+        # select rather than a blocking read: a stalled process (or a child still holding
+        # the pipe after it died) would otherwise never produce EOF.
+        ready, _, _ = select.select([fd], [], [], remaining)
+        if not ready:
+            continue
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            output = b"\n".join(tail).decode(errors="replace")
+            raise RuntimeError(f"{proc.args[0]} exited before sending {wanted}; last output:\n{output}")
+        buf += chunk
+
+
 class Engine:
-    def __init__(self, path: Path) -> None:
+    def __init__(self, path: Path, reuse_tt: bool = False, timeout: Optional[float] = None) -> None:
+        # With reuse_tt the hash table is kept between positions instead of being
+        # cleared by ucinewgame; entries from earlier searches may then warm up
+        # tactics slightly, which is usually fine for WAC.
+        self.reuse_tt = reuse_tt
+        # Seconds allowed per reply on top of any requested movetime; None waits forever.
+        self.timeout = timeout
         self.proc = subprocess.Popen(
             [str(path)],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
+            bufsize=0,
+            **SPAWN_KWARGS,
         )
+        self._buf = bytearray()
 
     def _write(self, command: str) -> None:
         assert self.proc.stdin is not None
-        self.proc.stdin.write(command + "\n")
-        self.proc.stdin.flush()
+        self.proc.stdin.write(command.encode() + b"\n")
 
-    def _read_until(self, token: str) -> None:
-        assert self.proc.stdout is not None
-        for line in self.proc.stdout:
-            if token in line:
-                return
+    def _deadline(self, search_seconds: float = 0.0) -> Optional[float]:
+        if self.timeout is None:
+            return None
+        return time.monotonic() + search_seconds + self.timeout
 
     def initialise(self) -> None:
         self._write("uci")
-        self._read_until("uciok")
+        read_until(self.proc, self._buf, b"uciok", self._deadline())
         self._write("isready")
-        self._read_until("readyok")
+        read_until(self.proc, self._buf, b"readyok", self._deadline())
 
     def bestmove(self, fen: str, depth: Optional[int], movetime_ms: Optional[int]) -> str:
         assert depth is not None or movetime_ms is not None
-        self._write("ucinewgame")
+        if not self.reuse_tt:
+            self._write("ucinewgame")
+            # Let the engine finish clearing its tables before the search starts.
+            self._write("isready")
+            read_until(self.proc, self._buf, b"readyok", self._deadline())
         self._write(f"position fen {fen}")
         if depth is not None:
             self._write(f"go depth {depth}")
+            deadline = self._deadline()
         else:
             self._write(f"go movetime {movetime_ms}")
-        assert self.proc.stdout is not None
-        for line in self.proc.stdout:
-            if line.startswith("bestmove"):
-                parts = line.split()
-                if len(parts) >= 2:
-                    return parts[1]
-                return ""
-        return ""
+            deadline = self._deadline(movetime_ms / 1000)
+        parts = read_until(self.proc, self._buf, b"bestmove", deadline).split()
+        return parts[1] if len(parts) >= 2 else ""
 
     def quit(self) -> None:
         try:
             self._write("quit")
         except BrokenPipeError:
             pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class SanConverter:
+    """Persistent ``bby-san-to-uci`` process answering one (fen, san) pair per line."""
+
+    def __init__(self, path: Path) -> None:
+        self.proc = subprocess.Popen(
+            [str(path)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+            **SPAWN_KWARGS,
+        )
+        self._buf = bytearray()
+        self._lock = threading.Lock()
+
+    def convert(self, fen: str, san: str) -> Optional[str]:
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        with self._lock:
+            self.proc.stdin.write(f"{fen}\n{san}\n".encode())
+            result = read_until(self.proc, self._buf, b"", time.monotonic() + CONVERT_TIMEOUT)
+        if result.startswith("error"):
+            sys.stderr.write(f"[san-to-uci] {san} failed: {result}\n")
+            return None
+        return result
+
+    def close(self) -> None:
+        if self.proc.stdin is not None:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
         self.proc.wait(timeout=5)
 
 
-def convert_san(converter: Path, fen: str, san: str) -> Optional[str]:
-    completed = subprocess.run(
-        [str(converter)],
-        input=f"{fen}\n{san}\n",
-        text=True,
-        capture_output=True,
-        check=False,
-    )
-    if completed.returncode != 0:
-        sys.stderr.write(f"[san-to-uci] {san} failed: {completed.stderr.strip()}\n")
-        return None
-    return completed.stdout.strip()
+def load_san_cache(path: Path) -> Dict[str, str]:
+    """Load persisted SAN->UCI conversions keyed by ``f"{fen}\\0{san}"``."""
+    try:
+        with path.open("r", encoding="utf-8") as handle:
+            data = json.load(handle)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as exc:
+        sys.stderr.write(f"[san-cache] ignoring unreadable cache {path}: {exc}\n")
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {str(key): str(value) for key, value in data.items()}
+
+
+def save_san_cache(path: Path, cache: Dict[str, str]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+    with tmp.open("w", encoding="utf-8") as handle:
+        json.dump(cache, handle, sort_keys=True, indent=0)
+    os.replace(tmp, path)
+
+
+def lookup_san(
+    converter: SanConverter, san_cache: Optional[Dict[str, str]], fen: str, san: str
+) -> Optional[str]:
+    if san_cache is None:
+        return converter.convert(fen, san)
+    key = f"{fen}\0{san}"
+    cached = san_cache.get(key)
+    if cached is not None:
+        return cached
+    converted = converter.convert(fen, san)
+    if converted:
+        san_cache[key] = converted
+    return converted
 
 
 def run_suite(
@@ -134,27 +252,69 @@ def run_suite(
     movetime_ms: Optional[int],
     verbose: bool,
     fail_on_miss: bool,
+    san_cache: Optional[Dict[str, str]] = None,
+    jobs: int = 1,
+    reuse_tt: bool = False,
+    timeout: Optional[float] = None,
 ) -> int:
-    engine = Engine(engine_path)
+    converter = SanConverter(converter_path)
+    engines: List[Engine] = []
+    engines_lock = threading.Lock()
+    local = threading.local()
+
+    def worker_engine() -> Engine:
+        # Each pool thread owns one engine for the whole run.
+        engine = getattr(local, "engine", None)
+        if engine is None:
+            engine = Engine(engine_path, reuse_tt, timeout)
+            with engines_lock:
+                engines.append(engine)
+            engine.initialise()
+            local.engine = engine
+        return engine
+
+    def convert_all(pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[str]]:
+        return {(fen, san): lookup_san(converter, san_cache, fen, san) for fen, san in pairs}
+
+    def solve(pos: Position) -> str:
+        return worker_engine().bestmove(pos.fen, depth, movetime_ms)
+
     try:
-        engine.initialise()
         solved = 0
         total = len(positions)
-        for idx, pos in enumerate(positions, start=1):
-            expected: Set[str] = set()
-            for san in pos.sans:
-                converted = convert_san(converter_path, pos.fen, san)
-                if converted:
-                    expected.add(converted)
-            best = engine.bestmove(pos.fen, depth, movetime_ms)
-            ident = pos.ident or f"WAC.{idx:03d}"
-            ok = best in expected and best != ""
-            if ok:
-                solved += 1
-            if verbose or not ok:
-                print(
-                    f"{ident}: {'OK' if ok else 'MISS'} expected={sorted(expected) if expected else None} got={best}"
-                )
+        # Each distinct (fen, san) is converted once, on its own thread, while the
+        # engines warm up and search; the converter serialises requests anyway.
+        pairs = sorted({(pos.fen, san) for pos in positions for san in pos.sans})
+        with ThreadPoolExecutor(max_workers=1) as convert_pool, ThreadPoolExecutor(
+            max_workers=jobs
+        ) as pool:
+            try:
+                conversions = convert_pool.submit(convert_all, pairs)
+                futures = [pool.submit(solve, pos) for pos in positions]
+                uci_map = conversions.result()
+                # Report in suite order regardless of which worker finishes first.
+                for idx, (pos, future) in enumerate(zip(positions, futures), start=1):
+                    best = future.result()
+                    expected: Set[str] = set()
+                    for san in pos.sans:
+                        converted = uci_map.get((pos.fen, san))
+                        if converted:
+                            expected.add(converted)
+                    ident = pos.ident or f"WAC.{idx:03d}"
+                    ok = best in expected and best != ""
+                    if ok:
+                        solved += 1
+                    if verbose or not ok:
+                        print(
+                            f"{ident}: {'OK' if ok else 'MISS'} expected={sorted(expected) if expected else None} got={best}",
+                            flush=True,
+                        )
+            except BaseException:
+                # Ctrl-C or a failed worker (e.g. an engine TimeoutError): drop the queued
+                # searches instead of letting the executors' exit run the whole suite.
+                convert_pool.shutdown(wait=False, cancel_futures=True)
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
         if depth is not None:
             descriptor = f"depth {depth}"
         else:
@@ -164,7 +324,9 @@ def run_suite(
             return 1
         return 0
     finally:
-        engine.quit()
+        converter.close()
+        for engine in engines:
+            engine.quit()
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -190,7 +352,30 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
         "--converter", type=Path, default=DEFAULT_CONVERTER, help="path to bby-san-to-uci helper"
     )
     parser.add_argument("--epd", type=Path, default=DEFAULT_EPD, help="EPD suite path")
+    parser.add_argument(
+        "--san-cache",
+        type=Path,
+        default=None,
+        help="JSON file memoising SAN->UCI conversions across runs (created if missing)",
+    )
     parser.add_argument("--limit", type=int, default=None, help="Cap positions (overrides --mode)")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) // 2),
+        help="engine processes searching in parallel (default: half the CPU count)",
+    )
+    parser.add_argument(
+        "--reuse-tt",
+        action="store_true",
+        help="skip ucinewgame between positions so the hash table carries over",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="seconds to wait for each engine reply, on top of --movetime for searches (default: no limit)",
+    )
     parser.add_argument("--verbose", action="store_true", help="Log every position, not just misses")
     parser.add_argument("--fail-on-miss", action="store_true", help="Exit with code 1 if any position fails")
     args = parser.parse_args(argv)
@@ -212,14 +397,33 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
         depth = None
     elif depth is None:
         parser.error("either --depth or --movetime must be provided")
+    if args.jobs < 1:
+        parser.error("--jobs must be positive")
+    if args.timeout is not None and args.timeout <= 0:
+        parser.error("--timeout must be positive")
 
     positions = parse_epd(args.epd, limit)
     if not positions:
         parser.error("no positions parsed from EPD")
 
-    return run_suite(
-        args.engine, args.converter, positions, depth, movetime_ms, args.verbose, args.fail_on_miss
-    )
+    san_cache = load_san_cache(args.san_cache) if args.san_cache is not None else None
+    try:
+        return run_suite(
+            args.engine,
+            args.converter,
+            positions,
+            depth,
+            movetime_ms,
+            args.verbose,
+            args.fail_on_miss,
+            san_cache,
+            args.jobs,
+            args.reuse_tt,
+            args.timeout,
+        )
+    finally:
+        if args.san_cache is not None and san_cache is not None:
+            save_san_cache(args.san_cache, san_cache)
 
 
 if __name__ == "__main__":